@@ -1,16 +1,75 @@
 #!/usr/bin/env python
 
+import mmap
 import os
 import os.path
+import re
 import sys
+from collections import deque
+from contextlib import contextmanager
 
 VERSION = (0, 1, 0)
 
+# Patterns used when parsing source files, compiled once at import time.
+# These match against the raw bytes of a file, see _open_source().
+# Module definitions and include statements are found in a single pass,
+# telling them apart by which named group took part in the match. A module
+# definition must open the file, preceded by nothing but a byte order mark,
+# whitespace and comments, and its dependency list is matched lazily so
+# that it never runs into the module body. A block comment can't extend
+# past its first */, as otherwise a run of leading comments could be
+# matched in exponentially many ways once the module alternative fails.
+_SOURCE_RE = re.compile(
+    br'(?:\A(?:\xef\xbb\xbf)?(?:\s|//[^\n]*\n|/\*(?:[^*]|\*(?!/))*\*/)*away3d\.module\(\s?["\'](?P<mod_name>[_a-zA-Z0-9.]*)["\']\s?,\s?(?P<mod_deps>.*?),\s?function\(\)\s?\{(?P<mod_body>.*)\}\s?\)\s*;?\s*$)'
+    br'|(?:away3d\.include\(\s*(?P<inc_deps>[\[\]_a-zA-Z0-9., "\'\s]*),\s*function\(\s*\))', re.DOTALL)
+_DEP_RE = re.compile(br'["\']([a-zA-Z0-9.]+)["\']')
+
+# Finds module definitions that _SOURCE_RE failed to parse. Only calls at
+# the start of a line count, so that mentions in comments or strings don't.
+_MOD_CALL_RE = re.compile(br'^\s*away3d\.module\(', re.MULTILINE)
+
+# Files smaller than this are read into memory, since setting up a
+# memory map costs more than it saves for them.
+_MMAP_MIN_SIZE = 4096
+
+
+@contextmanager
+def _open_source(fname):
+    "Opens a source file as a bytes-like buffer, memory mapping larger files"
+    with open(fname, 'rb') as f:
+        if os.fstat(f.fileno()).st_size < _MMAP_MIN_SIZE:
+            yield f.read()
+        else:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+                yield buf
+
+
+def _parse_source(fname):
+    "Reads a source file, returning the groups matched by _SOURCE_RE or None"
+    with _open_source(fname) as buf:
+        m = _SOURCE_RE.search(buf)
+
+        # A module definition that could not be parsed would otherwise be
+        # skipped without a trace.
+        if (m is None or m.group('mod_name') is None) and _MOD_CALL_RE.search(buf):
+            raise BuildException('Could not parse module definition in %s' % fname)
+
+        if m is not None:
+            return m.groupdict()
+
+
+def _decode(data):
+    "Decodes a matched part of a source file, normalizing line endings"
+    return data.decode('utf-8').replace('\r\n', '\n')
+
 
 class BuildException(Exception):
     pass
 
 class DepNode(object):
+    __slots__ = ('module', '_file_name', '_file_suffix', 'is_module', 'loaded',
+                 'content', 'dependencies', 'dependents')
+
     def __init__(self, module=None, file_name=None, is_module=True):
         self.module = module
         self.file_name = file_name
@@ -21,16 +80,26 @@ class DepNode(object):
         # For dependency graph
         self.dependencies = []
         self.dependents = []
-        self.visited = False
 
     def push_dependency(self, dep):
         self.dependencies.append(dep)
         dep.dependents.append(self)
 
+    @property
+    def file_name(self):
+        return self._file_name
+
+    @file_name.setter
+    def file_name(self, file_name):
+        # The suffix is derived here once, rather than on every lookup
+        self._file_name = file_name
+        if file_name is not None:
+            self._file_suffix = os.path.splitext(file_name)[1]
+        else:
+            self._file_suffix = None
+
     def get_file_suffix(self):
-        if self.file_name is not None:
-            name, ext = os.path.splitext(self.file_name)
-            return ext
+        return self._file_suffix
 
     def __str__(self):
         return '%s (%s)' % (self.module, self.file_name)
@@ -42,10 +111,20 @@ class DepGraph(object):
         self.all_nodes = []
 
     def build(self, inputs, sources):
-        import re
-
         cache = {}
-        queue = [DepNode(module=f, file_name=f) for f in inputs]
+
+        # Index sources by file name, so that modules can be looked up
+        # without scanning all sources. The first source wins on clashes.
+        source_index = {}
+        for source in sources:
+            source_index.setdefault(os.path.basename(source), source)
+
+        queue = deque(DepNode(module=f, file_name=f) for f in inputs)
+
+        # Leaves are tracked as the graph is built, i.e. a node is a leaf
+        # from when it's created until it gains its first dependency. A
+        # dict is used as an insertion ordered set, to keep output stable.
+        leaves = {}
 
         def has_node(mod_name, only_if_loaded=False):
             "Checks the cache for a node representing a module by this name"
@@ -60,25 +139,37 @@ class DepGraph(object):
         def get_node(mod_name):
             "Checks the cache for a node representing this module, or creates a new one"
             if not has_node(mod_name):
+                # Interned names make later cache lookups cheaper
+                mod_name = sys.intern(mod_name)
                 node = DepNode(mod_name)
                 self.all_nodes.append(node)
+                leaves[node] = None
                 cache[mod_name] = node
 
             return cache[mod_name]
 
         def guess_file(node):
             "Guesses which file contains a particular module from it's file name"
-            fields = node.module.split('.')
-            mod_name = fields[-1]
-            file_name = '%s.js' % mod_name
-            for source in sources:
-                if os.path.basename(source) == file_name:
-                    return source
+            mod_name = node.module.rsplit('.', 1)[-1]
+            return source_index.get('%s.js' % mod_name)
+
+        isfile_cache = {}
+
+        def isfile(path):
+            "Checks whether path is a file, remembering the result for this build"
+            result = isfile_cache.get(path)
+            if result is None:
+                result = os.path.isfile(path)
+                isfile_cache[path] = result
+
+            return result
 
         def add_node_dep(node, dep_name):
             existed = has_node(dep_name)
             dep = get_node(dep_name)
             node.push_dependency(dep)
+            if len(node.dependencies) == 1:
+                leaves.pop(node, None)
 
             # If this was a newly encountered module, add it
             # to the queue to try to load it (and any further
@@ -86,64 +177,66 @@ class DepGraph(object):
             if not existed:
                 queue.append(dep)
 
+        # Absolute paths of all files read so far, so that a file reached
+        # through more than one path (or listed twice) is only read once.
+        loaded_files = set()
 
-        mod_re = re.compile('away3d\.module\(\s?["\']([_a-zA-Z0-9.]*)["\']\s?,\s?(.*),\s?function\(\)\s?\{(.*)\}\s?\)\s?;?\s?$', re.DOTALL)
-        dep_re = re.compile('["\']([a-zA-Z0-9.]+)["\']')
-        inc_re = re.compile('away3d\.include\(\s*([\[\]_a-zA-Z0-9., "\'\s]*),\s*function\(\s*\)', re.DOTALL)
+        while queue:
+            node = queue.popleft()
 
-        for node in queue:
             # Check if this node has already been checked since
             # it was added to the queue.
             if has_node(node.module, only_if_loaded=True):
                 continue
 
             fname = node.file_name or guess_file(node)
-            if fname is None or not os.path.isfile(fname):
+            if fname is None or not isfile(fname):
                 raise BuildException('Could not find file for module %s' % node.module)
 
-            with open(fname, 'r') as f:
-                buf = f.read()
-                m = re.search(mod_re, buf)
+            abs_fname = os.path.abspath(fname)
+            if abs_fname in loaded_files:
+                continue
 
-                if m is not None:
-                    name = m.group(1)
-                    dep_arg = m.group(2).strip()
+            loaded_files.add(abs_fname)
 
-                    node = get_node(name)
-                    node.file_name = fname
-                    node.content = m.group(3)
-                    node.loaded = True
+            groups = _parse_source(fname)
 
-                    dep_names = re.findall(dep_re, dep_arg)
+            if groups is None:
+                continue
 
-                    for dep_name in dep_names:
-                        add_node_dep(node, dep_name)
+            if groups['mod_name'] is not None:
+                name = _decode(groups['mod_name'])
+                dep_arg = groups['mod_deps'].strip()
 
+                node = get_node(name)
+                node.file_name = fname
+                node.content = _decode(groups['mod_body'])
+                node.loaded = True
+
+                dep_names = [_decode(d) for d in _DEP_RE.findall(dep_arg)]
+
+                for dep_name in dep_names:
+                    add_node_dep(node, dep_name)
 
-                else:
-                    # Not a module file, but it might still contain include
-                    # statements and hence have dependencies.
-                    m = re.search(inc_re, buf)
-                    if m is not None:
-                        dep_arg = m.group(1)
-                        dep_names = re.findall(dep_re, dep_arg)
-                        if len(dep_names) > 0:
-                            # This is not a proper module, so using file name
-                            # as module name.
-                            file_node = get_node(fname)
-                            file_node.file_name = fname
-                            file_node.module = fname
-                            file_node.is_module = False
-
-                            for dep_name in dep_names:
-                                add_node_dep(node, dep_name)
-        
-
-        # Leaves list should contain all leaf nodes, i.e. nodes that do
-        # not have any dependencies.
-        for node in self.all_nodes:
-            if len(node.dependencies) == 0:
-                self.leaves.append(node)
+
+            else:
+                # Not a module file, but it might still contain include
+                # statements and hence have dependencies.
+                dep_arg = groups['inc_deps']
+                dep_names = [_decode(d) for d in _DEP_RE.findall(dep_arg)]
+                if len(dep_names) > 0:
+                    # This is not a proper module, so using file name
+                    # as module name.
+                    file_node = get_node(fname)
+                    file_node.file_name = fname
+                    file_node.module = fname
+                    file_node.is_module = False
+                    file_node.loaded = True
+
+                    for dep_name in dep_names:
+                        add_node_dep(file_node, dep_name)
+
+        self.leaves.extend(leaves)
 
         return self.leaves
 
@@ -152,37 +245,88 @@ class DepGraph(object):
     def evaluate_chain(self):
         chain = []
 
-        def visit(node):
-            if not node.visited:
-                node.visited = True
-                for dep in node.dependents:
-                    visit(dep)
-                chain.insert(0, node)
-
-        for node in self.leaves:
-            visit(node)
+        # Kahn's algorithm. Starting from the leaves, a node is appended to
+        # the chain once all of its dependencies are in it.
+        remaining = dict((node, len(node.dependencies)) for node in self.all_nodes)
+        queue = deque(self.leaves)
+        while queue:
+            node = queue.popleft()
+            chain.append(node)
+            for dep in node.dependents:
+                remaining[dep] -= 1
+                if remaining[dep] == 0:
+                    queue.append(dep)
+
+        # Any node that never made it into the chain is part of, or
+        # depends on, a cycle.
+        evaluated = set(chain)
+        unresolved = [node.module for node in self.all_nodes if node not in evaluated]
+        if len(unresolved) > 0:
+            raise BuildException('Circular dependency involving modules %s' % ', '.join(unresolved))
 
         return chain
 
 
+def _iter_js_files(path):
+    "Yields paths of all .js files in the directory tree below path"
+    # The type of a DirEntry is usually known from the directory listing
+    # itself, so unlike os.walk() this needs no extra stat() per entry.
+    stack = [path]
+    while stack:
+        dirname = stack.pop()
+        try:
+            it = os.scandir(dirname)
+        except OSError:
+            raise BuildException('Could not read %s' % dirname)
+
+        with it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                elif entry.name.endswith('.js'):
+                    yield entry.path
+
+
 def find_js_files(path):
     # In the special case that path is a file, the user should probably
     # be trusted with using this file, even if it's suffix is not js
     if os.path.isfile(path):
         return [path]
 
-    found = []
-    def visit(arg, dirname, names):
-        for name in names:
-            base, ext = os.path.splitext(name)
-            if ext == '.js':
-                found.append(os.path.join(dirname, name))
+    return list(_iter_js_files(path))
+
 
-    os.path.walk(path, visit, None)
-    return found
+def find_all_js_files(paths):
+    "Finds JS files for several paths, scanning each distinct path only once"
+    # Paths are told apart by their real path, but the first spelling given
+    # is the one that is scanned, so that reported file names are unchanged.
+    roots = {}
+    for path in paths:
+        roots.setdefault(os.path.realpath(path), path)
+
+    # Dicts are used as insertion ordered sets, to drop duplicate files
+    # found through overlapping paths while keeping a stable order.
+    found = {}
+    for path in roots.values():
+        found.update(dict.fromkeys(find_js_files(path)))
+
+    return list(found)
     
 
 
+def _create_arg_parser():
+    "Creates the parser for options common to all commands"
+    import argparse
+
+    # Usage is documented by printhelp(), so argparse's own help is disabled
+    parser = argparse.ArgumentParser(prog='buildaway.py', add_help=False)
+    parser.add_argument('-i', dest='input_paths', action='append', default=[], metavar='path')
+    parser.add_argument('-s', dest='source_paths', action='append', default=[], metavar='path')
+    parser.add_argument('-o', dest='output', metavar='path')
+    parser.add_argument('-t', dest='module_format', metavar='fmt')
+    return parser
+
+
 class BuildOpts(object):
     def __init__(self):
         self.inputs = []
@@ -191,63 +335,57 @@ class BuildOpts(object):
         self.module_format = 'away3d'
 
     def parse_args(self, args):
-        import getopt
-
-        inputs = []
-        sources = []
-        output = None
+        # Output and module format are written straight onto this object,
+        # with their current values acting as defaults.
+        _create_arg_parser().parse_args(args, namespace=self)
 
-        opts, extras = getopt.getopt(sys.argv[2:], 's:i:o:t:')
+        self.inputs.extend(find_all_js_files(self.input_paths))
+        self.sources.extend(find_all_js_files(self.source_paths))
 
-        for opt in opts:
-            if opt[0] == '-i':
-                self.inputs.extend(find_js_files(opt[1]))
-            elif opt[0] == '-s':
-                self.sources.extend(find_js_files(opt[1]))
-            elif opt[0] == '-o':
-                self.output = opt[1]
-            elif opt[0] == '-t':
-                self.module_format = opt[1]
-
-    def output_as_file(self):
+    def output_as_file(self, binary=False):
         if self.output is None:
-            return sys.stdout
+            return sys.stdout.buffer if binary else sys.stdout
         else:
-            return open(self.output, 'w')
+            return open(self.output, 'wb' if binary else 'w')
 
 
 class ModuleTranslator(object):
+    "Writes modules in the configured format, as UTF-8 to binary mode files"
+
     def __init__(self, module_format):
         self.module_format = module_format
 
     def print_header(self, out_file):
         if self.module_format == 'away3d':
-            out_file.write('away3d = {}\n')
-            out_file.write('away3d.originOfModule = function() { return "%s"; }\n\n' % out_file.name)
+            header = 'away3d = {}\n'
+            header += 'away3d.originOfModule = function() { return "%s"; }\n\n' % out_file.name
+            out_file.write(header.encode('utf-8'))
 
     def translate_to_file(self, node, out_file, include_deps=True, comment_file=True):
+        # The translated module is assembled in parts and written in one go,
+        # rather than issuing a separate write for every fragment.
+        parts = []
+
+        # Files that are not modules are copied verbatim
         if not node.is_module:
-            with open(node.file_name, 'r') as in_file:
-                out_file.write(in_file.read());
+            with open(node.file_name, 'rb') as in_file:
+                out_file.write(in_file.read())
+
+        content = node.content.lstrip('\n')
 
         # Use "native" away3d module format.
         if self.module_format == 'away3d':
-            out_file.write('// %s\n' % node.file_name)
+            parts.append('// %s\n' % node.file_name)
             if include_deps:
-                out_file.write('away3d.module("%s", ' % node.module)
                 if len(node.dependencies) > 0:
                     deps = ',\n'.join([ "\t'%s'" % d.module for d in node.dependencies])
-                    out_file.write('[\n%s\n],' % deps)
+                    deps = '[\n%s\n],' % deps
                 else:
-                    out_file.write('null,')
+                    deps = 'null,'
 
-                out_file.write('\nfunction()\n{\n')
-                out_file.write(node.content.lstrip('\n'))
-                out_file.write('\n});')
+                parts.append('away3d.module("%s", %s\nfunction()\n{\n%s\n});' % (node.module, deps, content))
             else:
-                out_file.write('%s = (function() {\n' % node.module)
-                out_file.write(node.content.lstrip('\n'))
-                out_file.write('})();\n\n')
+                parts.append('%s = (function() {\n%s})();\n\n' % (node.module, content))
 
         # Convert to the module format used by the Require.js library.
         elif self.module_format == 'require.js':
@@ -256,47 +394,44 @@ class ModuleTranslator(object):
             else:
                 deps = ''
 
-            out_file.write('// %s\n' % node.file_name)
-            out_file.write('define("%s", [%s], function() {\n' % (node.module, deps))
-            out_file.write(node.content.lstrip('\n'))
-            out_file.write('});\n\n')
+            parts.append('// %s\n' % node.file_name)
+            parts.append('define("%s", [%s], function() {\n%s});\n\n' % (node.module, deps, content))
 
         # Convert to the Google Closure compiler module format.
         elif self.module_format == 'closure':
-            out_file.write('// %s\n' % node.file_name)
-            out_file.write('goog.provide("%s");\n' % node.module)
+            parts.append('// %s\n' % node.file_name)
+            parts.append('goog.provide("%s");\n' % node.module)
             if include_deps:
                 for dep in node.dependencies:
-                    out_file.write('goog.require("%s");\n' % dep.module)
+                    parts.append('goog.require("%s");\n' % dep.module)
+
+            parts.append('\n%s = (function() {\n%s})();\n\n' % (node.module, content))
 
-            out_file.write('\n%s = (function() {\n' % node.module)
-            out_file.write(node.content.lstrip('\n'))
-            out_file.write('})();\n\n')
+        out_file.write(''.join(parts).encode('utf-8'))
 
     def translate_to_path(self, node, out_path, include_deps=True):
-        with open(out_path, 'w') as out_file:
+        with open(out_path, 'wb') as out_file:
             self.translate_to_file(node, out_file, include_deps)
 
 
 def listdep(graph, opts):
     "List module dependencies in order of dependency."
-    output = opts.output_as_file()
+    output = opts.output_as_file(binary=True)
     chain = graph.evaluate_chain()
-    for node in chain:
-        output.write('%s\n' % node)
+    output.write(''.join(['%s\n' % node for node in chain]).encode('utf-8'))
+    output.flush()
 
 
 def concat(graph, opts):
     "Concatenate module files in order of dependency."
-    output = opts.output_as_file()
+    output = opts.output_as_file(binary=True)
     chain = graph.evaluate_chain()
 
     translator = ModuleTranslator(opts.module_format)
     translator.print_header(output)
 
     for node in chain:
-        name, ext = os.path.splitext(node.file_name)
-        if ext == '.js':
+        if node.get_file_suffix() == '.js':
             translator.translate_to_file(node, output, False)
 
     output.close()
@@ -320,21 +455,7 @@ def gather(graph, opts):
 
 
 def printhelp():
-    print('')
-    print('Away3D.js build tool, version %d.%d.%d' % VERSION)
-    print('')
-    print('Commands available:')
-    print('  help       Print this message.')
-    for key, val in commands.items():
-        print('  %s %s' % (key.ljust(10), val.__doc__))
-
-    print('')
-    print('Options available:')
-    print('  -i <path>  Specifies a required input.')
-    print('  -s <path>  Specifies a path to search for dependencies.')
-    print('  -o <path>  Specifies output file or directory.')
-    print('  -t <fmt>   Converts to other module formats. Can be "require.js" or "closure".')
-    print('')
+    print(_HELP_TEXT)
 
 
 # These are the commands that the tool supports (excluding the help command)
@@ -344,6 +465,22 @@ commands = {
     'gather': gather,
 }
 
+_HELP_TEXT = '\n'.join([
+    '',
+    'Away3D.js build tool, version %d.%d.%d' % VERSION,
+    '',
+    'Commands available:',
+    '  help       Print this message.',
+] + ['  %s %s' % (key.ljust(10), val.__doc__) for key, val in commands.items()] + [
+    '',
+    'Options available:',
+    '  -i <path>  Specifies a required input.',
+    '  -s <path>  Specifies a path to search for dependencies.',
+    '  -o <path>  Specifies output file or directory.',
+    '  -t <fmt>   Converts to other module formats. Can be "require.js" or "closure".',
+    '',
+])
+
 if __name__ == '__main__':
     if len(sys.argv) > 1:
 
@@ -352,10 +489,10 @@ if __name__ == '__main__':
             printhelp()
         else:
             if cmd in commands:
-                opts = BuildOpts()
-                opts.parse_args(sys.argv[2:])
-
                 try:
+                    opts = BuildOpts()
+                    opts.parse_args(sys.argv[2:])
+
                     graph = DepGraph()
                     graph.build(opts.inputs, opts.sources)
                     commands[cmd](graph, opts)
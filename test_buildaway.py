@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+import buildaway
+
+
+class SourcePatternTest(unittest.TestCase):
+    def test_leading_comments_do_not_backtrack(self):
+        # Used to take time exponential in the number of comments
+        buf = b'/* a */\n' * 200 + b'var x = 1;\n'
+        start = time.time()
+        m = buildaway._SOURCE_RE.search(buf)
+        self.assertIsNone(m)
+        self.assertLess(time.time() - start, 1.0)
+
+    def test_module_after_leading_comments(self):
+        buf = b'/* a */\n// b\n/* c ** d */\naway3d.module("a.B", null, function() {\n});\n'
+        m = buildaway._SOURCE_RE.search(buf)
+        self.assertEqual(m.group('mod_name'), b'a.B')
+
+    def test_module_with_trailing_blank_lines(self):
+        buf = b'away3d.module("a.B", null, function() {\n});\n\n\n'
+        m = buildaway._SOURCE_RE.search(buf)
+        self.assertEqual(m.group('mod_name'), b'a.B')
+
+
+class DepGraphTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def write(self, name, content):
+        path = os.path.join(self.dir, name)
+        with open(path, 'w') as f:
+            f.write(content)
+        return path
+
+    def test_include_file_follows_its_dependencies(self):
+        b = self.write('B.js', 'away3d.module("a.B", null, function() {\n});\n')
+        main = self.write('main.js', 'away3d.include(["a.B"], function() {\n});\n')
+
+        graph = buildaway.DepGraph()
+        graph.build([main], [b])
+        chain = [node.file_name for node in graph.evaluate_chain()]
+        self.assertEqual(chain, [b, main])
+
+
+class FindJsFilesTest(unittest.TestCase):
+    def test_missing_path(self):
+        path = os.path.join(tempfile.gettempdir(), 'buildaway-no-such-dir')
+        self.assertRaises(buildaway.BuildException, buildaway.find_js_files, path)
+
+
+if __name__ == '__main__':
+    unittest.main()